@@ -8,7 +8,11 @@ from IPython.display import display
 from IPython.display import IFrame
 from IPython.utils.py3compat import unicode_to_str
 
-from . import driver
+# driver imports the html generating modules (and pygments) as well, so all of that is
+# loaded with the extension rather than during the first profiled cell
+from pprofile_ext import driver
+
+__all__ = ['PProfileMagics', 'load_ipython_extension', 'unload_ipython_extension']
 
 
 def get_arg(arg, cast):
@@ -1,6 +1,4 @@
-from collections import defaultdict
-from functools import partial
-import itertools
+import errno
 import os
 import os.path
 
@@ -9,6 +7,9 @@ from pprofile_ext import util
 from pprofile_ext.html import file
 from pprofile_ext.html import summary
 
+# states of the pprofile.txt parser
+SUMMARY, FILE_HEADER, FILE_BODY = range(3)
+
 
 def get_reverse_dict(pdict):
     """
@@ -18,19 +19,39 @@ def get_reverse_dict(pdict):
     :param pdict: profile dictionary
     :return: reverse call dictionary
     """
-    def update_reverse_call_dict(hashkey, line_number):
-        """Helper function to update the info in the reverse call dictionary"""
-        rdict[hashkey][line_number][(from_file, from_line['line_number'])] += from_line['hits']
-        return rdict
-
-    rdict = defaultdict(partial(defaultdict, (partial(defaultdict, int))))
-    for key, fdict in pdict.items():
-        if key != 'summary':
-            from_file = fdict['file_summary']['name']
-            for from_line in fdict['lines']:
-                for call in from_line['calls']:
-                    rdict = update_reverse_call_dict(util.hashkey(call['file_name']),
-                                                     call['line_number'])
+    # separate the files from the summary once: (file_name, file hash, lines) for each file
+    files = [(fdict['file_summary']['name'], key, fdict['lines']) for key, fdict in pdict.items() if key != 'summary']
+
+    # map of file_name to file hash in the profile dictionary, so the file names of the
+    # calls don't have to be hashed again. Calls into files that are not in the profile
+    # are skipped since there are no lines to add the reverse call information to
+    filemap = dict((from_file, key) for from_file, key, _ in files)
+
+    # every call site yields a ((hashkey, line_number, from_file, from_line_number), hits) event
+    events = (((filemap[call['file_name']], call['line_number'], from_file, from_line['line_number']),
+               from_line['hits'])
+              for from_file, _, lines in files
+              for from_line in lines
+              for call in from_line['calls'] if call['file_name'] in filemap)
+
+    # count the hits in a flat dict keyed by (hashkey, line_number, from_file, from_line_number);
+    # a plain dict with a bound get avoids the python level Counter.__missing__ for new keys
+    counts = dict()
+    counts_get = counts.get
+    for event, hits in events:
+        counts[event] = counts_get(event, 0) + hits
+
+    # and pivot the counts into {hashkey: {line_number: {(from_file, from_line_number): hits}}}
+    # (no setdefault here, that would allocate two throwaway dicts per entry)
+    rdict = dict()
+    for (hashkey, line_number, from_file, from_line_number), hits in counts.items():
+        lines = rdict.get(hashkey)
+        if lines is None:
+            lines = rdict[hashkey] = dict()
+        calls_from = lines.get(line_number)
+        if calls_from is None:
+            calls_from = lines[line_number] = dict()
+        calls_from[(from_file, from_line_number)] = hits
 
     return rdict
 
@@ -46,28 +67,51 @@ def update_profile_dict_with_reverse_dict(pdict, rdict):
     """
     for key, calls_from in rdict.items():
         if key in pdict:
-            for line in pdict[key]['lines']:
-                if line['line_number'] in calls_from:
-                    line['calls_from'] = calls_from[line['line_number']]
+            # index the lines of the file by line number once
+            lines = dict((line['line_number'], line) for line in pdict[key]['lines'])
+            for line_number, calls in calls_from.items():
+                line = lines.get(line_number)
+                if line is not None:
+                    line['calls_from'] = calls
 
     return pdict
 
 
-def get_profile_dict(stream):
+def get_profile_dict(lines):
     """
-    Consumes the `stream` containing the pprofile output and returns a dictionary containing
-    the parsed profile information
+    Consumes the `lines` containing the pprofile output and returns a dictionary containing
+    the parsed profile information. The lines are consumed in a single pass; every line is
+    handed to the handler belonging to the section of the output the line is in:
+
+        SUMMARY      lines before the first 'File:' line
+        FILE_HEADER  lines from 'File:' up to the '-----' delimiter of the line table
+        FILE_BODY    lines of the line table
 
-    :param stream: stream
+    :param lines: sequence of lines without the trailing newline
     :return: dictionary
     """
-    lines = (line.rstrip('\n') for line in stream)
-
-    profile_dict = dict()
-    for section in handlers.split_sections(lines):
-        for section_dict in itertools.chain.from_iterable(handlers.parse_section(section, (handlers.summary_handler,
-                                                                                           handlers.file_handler))):
-            profile_dict = util.update(profile_dict, section_dict)
+    # bind the handler of the line table to a local, it is called for almost every line
+    line_handler = handlers.line_handler
+
+    profile_dict = {'summary': dict()}
+    file_dict, file_lines = None, None
+    state = SUMMARY
+    for line in lines:
+        if line.startswith('File:'):
+            # start of a new file section
+            file_dict = handlers.file_handler(line)
+            file_lines = file_dict['lines']
+            profile_dict[util.hashkey(file_dict['file_summary']['name'])] = file_dict
+            state = FILE_HEADER
+        elif state == FILE_BODY:
+            line_handler(file_lines, line)
+        elif state == FILE_HEADER:
+            if line.startswith('-----'):
+                state = FILE_BODY
+            else:
+                handlers.file_summary_handle(file_dict['file_summary'], line)
+        else:
+            handlers.summary_handler(profile_dict['summary'], line)
 
     return profile_dict
 
@@ -82,16 +126,20 @@ def process_profile(output_dir):
     """
     pname = os.path.abspath(os.path.join(output_dir, 'pprofile.txt'))
 
+    # read pprofile.txt in one go; split on '\n' only, unlike splitlines() this doesn't
+    # break source lines that contain form feeds and other line boundary characters
+    with open(pname, 'r', buffering=1 << 20) as f:
+        lines = f.read().split('\n')
+
     # parse pprofile.txt and create the html output
-    with open(pname, 'r') as f:
-        pdict = get_profile_dict(f)
-        rdict = get_reverse_dict(pdict)
-        pdict = update_profile_dict_with_reverse_dict(pdict, rdict)
+    pdict = get_profile_dict(lines)
+    rdict = get_reverse_dict(pdict)
+    pdict = update_profile_dict_with_reverse_dict(pdict, rdict)
 
-        # generate html pages: summary page first
-        pdict = summary.html_summary(pdict, output_dir)
-        # then an HTML file per file in the profile output
-        file.html_files(pdict, output_dir)
+    # generate html pages: summary page first
+    pdict = summary.html_summary(pdict, output_dir)
+    # then an HTML file per file in the profile output
+    file.html_files(pdict, output_dir)
 
     return output_dir + '/index.html'
 
@@ -104,7 +152,7 @@ def indent_code(code):
 
     :return: string containing indented code
     """
-    return [' ' * 4 + line for line in code.split('\n')]
+    return ' ' * 4 + code.replace('\n', '\n' + ' ' * 4)
 
 
 def compile_code(code, output_dir):
@@ -125,14 +173,11 @@ def compile_code(code, output_dir):
 
     pname = os.path.abspath(os.path.join(output_dir, 'pprofile.txt'))
 
-    pcode = ['import pprofile',
-             'profiler = pprofile.Profile()',
-             'with profiler():']
-
-    pcode += indent_code(code)
-    pcode += ["profiler.dump_stats('{0}')".format(pname)]
-
-    pcode = '\n'.join(pcode)
+    pcode = '\n'.join(('import pprofile',
+                       'profiler = pprofile.Profile()',
+                       'with profiler():',
+                       indent_code(code),
+                       "profiler.dump_stats('{0}')".format(pname)))
 
     return compile(pcode, '<string>', 'exec')
 
@@ -147,14 +192,23 @@ def create_output_dir(output_dir):
     :return: path to output_dir
     """
     # output_dir is a directory relative to the current working directory, which
-    # is at the same level as the notebook
-    path, cntr = output_dir, 1
-    while os.path.exists(path):
-        path = output_dir + '_{0}'.format(cntr)
-        cntr += 1
-
-    # create the actual directory
-    os.makedirs(path)
-
-    return path
+    # is at the same level as the notebook. List the parent directory once to find the
+    # first free name instead of probing the file system for every candidate name
+    parent = os.path.dirname(output_dir) or os.curdir
+    existing = set(os.listdir(parent)) if os.path.isdir(parent) else set()
 
+    path, cntr = output_dir, 1
+    while True:
+        while os.path.basename(path) in existing:
+            path = output_dir + '_{0}'.format(cntr)
+            cntr += 1
+
+        # create the actual directory; if someone else created it in the mean time
+        # move on to the next name
+        try:
+            os.makedirs(path)
+            return path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            existing.add(os.path.basename(path))
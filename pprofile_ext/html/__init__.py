@@ -2,10 +2,24 @@
 Collection of html generating functions for building out the profile html pages
 """
 import contextlib
+import io
 import os.path
 
+import six
 from pygments.formatters import HtmlFormatter
 
+# the pygments css for highlighted code is the same for every page
+HIGHLIGHT_STYLE_DEFS = HtmlFormatter().get_style_defs('.highlight')
+
+HTML_CACHE_SIZE = 4096
+HTML_FILENAME_CACHE = dict()
+LINE_URL_CACHE = dict()
+
+# the html generated by box() for every line is built by concatenating these around the widths
+BOX_PREFIX = '<div style="margin-top:-8px;margin-bottom:-8px;display:inline-block;height:12px;width:'
+BOX_SUFFIX_DARK = 'px;background-color:#0000ff";></div>'
+BOX_SUFFIX_LIGHT = 'px;background-color:#aaaaff";></div>'
+
 
 def box(width, cwidth, max_width, pix_width=100.):
     """
@@ -22,37 +36,64 @@ def box(width, cwidth, max_width, pix_width=100.):
     """
     cw = int(pix_width * cwidth / max_width) if cwidth > 0 else 0
     w = int(pix_width * width / max_width) if width > 0 else 0
-    b1 = '<div style="margin-top:-8px;margin-bottom:-8px;display:inline-block;height:12px;width:{0}px;background-color:#0000ff";></div>'.format(w)
-    b2 = '<div style="margin-top:-8px;margin-bottom:-8px;display:inline-block;height:12px;width:{0}px;background-color:#aaaaff";></div>'.format(cw - w)
 
-    return b2+b1
+    return BOX_PREFIX + str(cw - w) + BOX_SUFFIX_LIGHT + BOX_PREFIX + str(w) + BOX_SUFFIX_DARK
 
 
-def column_spec(name, func, width, padding_right=5, padding_left=5, align='right', vertical_align='middle'):
+class column_spec(object):
     """
-    Returns a function html_table_cell(item, header=False) that generates HTML for table cells
-    <td> for header == False and <th> for header == True according to the specification defined
-    by the input arguments, see below for more detail.
+    Specification of a table column that generates the HTML for the header cell <th> of the
+    column, see header(), and holds the HTML surrounding the content of the table cells <td>
+    of the column, prefix and suffix, which is the same for every cell so it is generated once.
+    The table cells themselves are generated by the row function returned by row_emitter.
 
-    :param name: name of the column, this will be the string displayed in a header cell, in case header == True
-    :param func: callable. The value returned by func(item) will be displayed in a table cell, in case header == False
+    :param name: name of the column, this will be the string displayed in the header cell
+    :param func: callable. The string returned by func(item) will be displayed in a table cell
     :param width: width of the column in pixels
     :param padding_right: right padding, in pixels of the table cell; default is 5 pixels
     :param padding_left: left padding, in pixels of the table cell; default is 5 pixels
     :param align: alignment of the table cell; default is 'right'
+    """
+
+    def __init__(self, name, func, width, padding_right=5, padding_left=5, align='right', vertical_align='middle'):
+        self.func = func
+        self.header_html = '<th align={0} vertical-align={5} style="spacing:0;padding-left:{1}px;padding-right:{2}px;" width={3}>{4}</td>'.\
+                           format(align, padding_left, padding_right, width, name, vertical_align)
+        self.prefix = '<td align={0} vertical-align={3} style="spacing:0;padding-left:{1}px;padding-right:{2}px;">'.\
+                      format(align, padding_left, padding_right, vertical_align)
+        self.suffix = '</td>'
+
+    def header(self):
+        """
+        HTML for the header cell of the column
+        """
+        return self.header_html
+
+
+def row_emitter(column_specs):
+    """
+    Returns a function row(item) that generates the HTML for a complete table row <tr> with a
+    cell for each of the `column_specs`. The function is generated and compiled at runtime with
+    the calls to the column funcs and the HTML surrounding the cells inlined, so that generating
+    a row is a single python call instead of one call per cell.
+
+    :param column_specs: sequence of column_spec
 
     :return: function
     """
-    def html_table_cell(item, header=False):
+    namespace = dict()
+    parts, literal = list(), '<tr>'
+    for idx, c in enumerate(column_specs):
+        namespace['func{0}'.format(idx)] = c.func
+        parts.append(repr(literal + c.prefix))
+        parts.append('func{0}(item)'.format(idx))
+        literal = c.suffix
+    parts.append(repr(literal + '</tr>'))
 
-        if header:
-            return '<th align={0} vertical-align={5} style="spacing:0;padding-left:{1}px;padding-right:{2}px;" width={3}>{4}</td>'.\
-                   format(align, padding_left, padding_right, width, name, vertical_align)
-        else:
-            return '<td align={0} vertical-align={4} style="spacing:0;padding-left:{1}px;padding-right:{2}px;">{3}</td>'.\
-                   format(align, padding_left, padding_right, func(item), vertical_align)
+    source = 'def row(item):\n    return \'\'.join(({0},))\n'.format(', '.join(parts))
+    exec(compile(source, '<row_emitter>', 'exec'), namespace)
 
-    return html_table_cell
+    return namespace['row']
 
 
 def strip_pointy(string):
@@ -75,18 +116,62 @@ def get_html_filename(root, py_filename):
 
     :return: uri
     """
-    if py_filename.startswith('<'):
-        html_name = strip_pointy(py_filename)
-    else:
-        # get the last couple of directories, we don't need the whole thing
-        dirname = '.'.join(os.path.dirname(py_filename).split('/')[-3:])
-        # get the filename
-        basename = os.path.basename(py_filename)
-        # join dirname and basename, strip any leading dots, and replace all
-        # other dots with underscore
-        html_name = (dirname + '_' + basename).lstrip('.').replace('.', '_')
+    # the same file names are looked up for every link to them, so cache the html name; the
+    # root differs per profile run so it is joined outside the cache. The cache is emptied once
+    # it holds HTML_CACHE_SIZE names so it doesn't grow without bounds
+    if py_filename not in HTML_FILENAME_CACHE:
+        if len(HTML_FILENAME_CACHE) >= HTML_CACHE_SIZE:
+            HTML_FILENAME_CACHE.clear()
+        if py_filename.startswith('<'):
+            html_name = strip_pointy(py_filename)
+        else:
+            # get the last couple of directories, we don't need the whole thing
+            dirname = '.'.join(os.path.dirname(py_filename).split('/')[-3:])
+            # get the filename
+            basename = os.path.basename(py_filename)
+            # join dirname and basename, strip any leading dots, and replace all
+            # other dots with underscore
+            html_name = (dirname + '_' + basename).lstrip('.').replace('.', '_')
+
+        HTML_FILENAME_CACHE[py_filename] = html_name + '.html'
+
+    return os.path.join(root, HTML_FILENAME_CACHE[py_filename])
+
+
+def get_line_url(py_filename, line_number):
+    """
+    Given a file name as displayed in the pprofile output and a line number generate the
+    uri, relative to the other html files, of the line in the html file for py_filename
+
+    :param py_filename: file path
+    :param line_number: line number
+
+    :return: uri
+    """
+    # the same lines are linked to from every line that calls them, so cache the result; the
+    # cache is emptied once it holds HTML_CACHE_SIZE urls so it doesn't grow without bounds
+    key = (py_filename, line_number)
+    if key not in LINE_URL_CACHE:
+        if len(LINE_URL_CACHE) >= HTML_CACHE_SIZE:
+            LINE_URL_CACHE.clear()
+        LINE_URL_CACHE[key] = '{0}#line{1}'.format(get_html_filename('', py_filename), line_number)
 
-    return os.path.join(root, html_name + '.html')
+    return LINE_URL_CACHE[key]
+
+
+def open_html(path):
+    """
+    Open the html file `path` for writing. On python 3 the generated HTML is encoded as utf-8
+    once, by the file object, when it is written; on python 2 the HTML is written as is.
+
+    :param path: path of the html file
+
+    :return: file object
+    """
+    if six.PY2:
+        return open(path, 'w', buffering=1 << 20)
+
+    return io.open(path, 'w', encoding='utf-8', buffering=1 << 20)
 
 
 def href(destination, text):
@@ -121,20 +206,22 @@ def pre(item):
 
 
 class html(object):
+    """
+    Collects the generated HTML in self.buffer or, if a file object `fp` is given, writes the
+    generated HTML directly to `fp`, in which case self.buffer stays empty.
 
-    def __init__(self):
-        self.buffer = list()
-
-    def add(self, string_or_list):
-        """
-        Adds a string or a list of strings to self.buffer
+    :keyword fp: file object to write the HTML to; default None
+    """
 
-        :param string_or_list: stuff
-        """
-        if isinstance(string_or_list, list):
-            self.buffer += string_or_list
+    def __init__(self, fp=None):
+        self.buffer = list()
+        # bind the output methods once, these are called for every piece of emitted HTML
+        if fp is None:
+            self.append = self.buffer.append
+            self.extend = self.buffer.extend
         else:
-            self.buffer.append(string_or_list)
+            self.append = fp.write
+            self.extend = fp.writelines
 
     @contextlib.contextmanager
     def preamble(self, **kwargs):
@@ -149,22 +236,22 @@ class html(object):
                          font_family: font for <body>, <pre>, <th>, <td>, <hX>; default: 'courier'
                          font_color: font color for <body>, <pre>, <th>, <td>, <hX>; default: '#000000'
         """
-        self.add('<html>')
-        self.add('<head>')
-        self.add('<title>{0}</title>'.format(kwargs.get('title', 'pprofile - python line profile')))
-        self.add('<style type="text/css">')
-        self.add('body, pre, th, td {{font-size:{0};}}'.format(kwargs.get('font_size', 'small')))
-        self.add('body {{background-color:{0};}}'.format(kwargs.get('background_color', '#eeeeee')))
-        self.add('table, th, td {{border: {0};}}'.format(kwargs.get('border', '1px solid #e0e0e0')))
-        self.add('body, pre, th, td, h1, h2, h3, h4 {{font-family:{0};color:{1}}}'
-                 .format(kwargs.get('font_family', 'courier'), kwargs.get('color', '#000000')))
-        self.add(HtmlFormatter().get_style_defs('.highlight'))
-        self.add('</style>')
-        self.add('</head>')
-        self.add('<body>')
+        self.append('<html>')
+        self.append('<head>')
+        self.append('<title>{0}</title>'.format(kwargs.get('title', 'pprofile - python line profile')))
+        self.append('<style type="text/css">')
+        self.append('body, pre, th, td {{font-size:{0};}}'.format(kwargs.get('font_size', 'small')))
+        self.append('body {{background-color:{0};}}'.format(kwargs.get('background_color', '#eeeeee')))
+        self.append('table, th, td {{border: {0};}}'.format(kwargs.get('border', '1px solid #e0e0e0')))
+        self.append('body, pre, th, td, h1, h2, h3, h4 {{font-family:{0};color:{1}}}'
+                    .format(kwargs.get('font_family', 'courier'), kwargs.get('color', '#000000')))
+        self.append(HIGHLIGHT_STYLE_DEFS)
+        self.append('</style>')
+        self.append('</head>')
+        self.append('<body>')
         yield
-        self.add('</body>')
-        self.add('</html>')
+        self.append('</body>')
+        self.append('</html>')
 
     @contextlib.contextmanager
     def title(self, level=2):
@@ -173,9 +260,9 @@ class html(object):
 
         :keyword level: number indicating the type of title, default is 2, which results in a <h2> tag
         """
-        self.add('<h{0}>'.format(level))
+        self.append('<h{0}>'.format(level))
         yield
-        self.add('</h{0}>'.format(level))
+        self.append('</h{0}>'.format(level))
 
     @contextlib.contextmanager
     def table(self, cellspacing=0):
@@ -184,15 +271,15 @@ class html(object):
 
         :keyword cellspacing: cellspacing for the table
         """
-        self.add('<table cellspacing={0}>'.format(cellspacing))
+        self.append('<table cellspacing={0}>'.format(cellspacing))
         yield
-        self.add('</table>')
+        self.append('</table>')
 
     @contextlib.contextmanager
     def table_row(self):
         """
         HTML table row start and end tag (<tr>)
         """
-        self.add('<tr>')
+        self.append('<tr>')
         yield
-        self.add('</tr>')
+        self.append('</tr>')
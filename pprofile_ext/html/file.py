@@ -1,4 +1,7 @@
+import bisect
+import heapq
 import re
+from operator import itemgetter
 
 import six
 from six.moves import zip
@@ -11,52 +14,93 @@ from pprofile_ext import html
 PYTHON_LEXER = PythonLexer()
 HTML_FORMATTER = HtmlFormatter()
 
+RE_LAMBDA = re.compile(r'(?<=\s)(\w*)(?=\s*=\s*lambda)')
+RE_CLS = re.compile(r'(?<=\s)(cls)(?=\()')
+RE_CLASS = re.compile(r'(?<=class\s)(\w*)(?=\()')
 
-def add_total_time(pdict):
-    """
-    For each line in the profile add an item holding the total execution time
-    for the line. The total execution time is the execution time of the line itself
-    and the execution time of any of the calls associated with the line.
+CALL_RE_CACHE = dict()
+CALL_RE_CACHE_SIZE = 4096
 
-    Also adds a label adding the total execution of all the lines in the file
-    to the 'file_summary' section.
+# <div> and <pre> tags wrapped around the highlighted code of a line when it is rendered
+HIGHLIGHT_PREFIX = '<div style="margin-top:-8px;margin-bottom:-8px;" class="highlight"><pre>'
+HIGHLIGHT_SUFFIX = '</pre></div>'
 
-    :param pdict: profile dict
-    :return: profile dict
-    """
+# html.div(html.pre(...)) wrapped around the numbers in the line tables, and the formatters of the numbers
+DIV_PRE_PREFIX = '<div style="margin-top:-8px;margin-bottom:-8px;"><pre>'
+DIV_PRE_SUFFIX = '</pre></div>'
+EMPTY_DIV_PRE = DIV_PRE_PREFIX + DIV_PRE_SUFFIX
+FORMAT_TIME = '{0:.4f}'.format
+FORMAT_TIME_PER_HIT = '{0:.2e}'.format
 
-    for line in pdict['lines']:
-        line['total_time'] = line['time'] + sum([c['time'] for c in line['calls']])
 
-    pdict['file_summary']['total_time'] = sum([line['total_time'] for line in pdict['lines']])
+def iter_lines(string):
+    """
+    Generator of the lines in `string`, split on '\\n'. Unlike string.split('\\n') the lines
+    are not materialized in a list up front but handed out one by one.
 
-    return pdict
+    :param string: string
+    :return: yields the lines in `string`
+    """
+    start = 0
+    while True:
+        end = string.find('\n', start)
+        if end == -1:
+            yield string[start:]
+            return
+        yield string[start:end]
+        start = end + 1
 
 
-def highlight_code(pdict):
+def highlight_code(lines):
     """
-    For each line in the profile add an item containing the syntax highlighted HTML
-    version of the code. The key of the time is 'highlight'
+    Returns the syntax highlighted HTML version of the code of each of the `lines`.
 
     The function used Pygments to do the parsing/highlihting
 
-    :param pdict: profile dict
-    :return: profile dict
+    :param lines: sequence of line dicts
+    :return: generator of strings containing the highlighted HTML, one for each line
     """
     # reconstruct the entire code so that we can get the syntax highlighting of
     # blocks correctly
-    html_code = highlight('\n'.join([(l['code'] if len(l['code']) > 0 else ' ') for l in pdict['lines']]),
+    html_code = highlight('\n'.join([(l['code'] if len(l['code']) > 0 else ' ') for l in lines]),
                           PYTHON_LEXER, HTML_FORMATTER)
 
-    # strip out the <div> and <pre> tags, we're going to replace them later
+    # strip out the <div> and <pre> tags, these are added back for every line when the
+    # line is rendered, see get_column_specs
     is_, ie_ = html_code.find('<pre>'), html_code.rfind('</pre>')
     html_code = html_code[is_+len('<pre>'):ie_]
 
-    # add back the <div> and <pre> tags, but for every line and add the highlighted code to the pdict
-    hcode = ['<div style="margin-top:-8px;margin-bottom:-8px;" class="highlight"><pre>{0}</pre></div>'.format(line.encode('utf-8').decode())
-             for line in html_code.split('\n')]
-    for line, _hcode in zip(pdict['lines'], hcode):
-        line['highlight'] = _hcode
+    return iter_lines(html_code)
+
+
+def prepare_lines(pdict):
+    """
+    Prepare the lines of the profile for generating the HTML in a single pass over the lines.
+    For each line
+
+      - add an item holding the total execution time for the line, 'total_time'. The total
+        execution time is the execution time of the line itself and the execution time of
+        any of the calls associated with the line.
+      - add an item containing the syntax highlighted HTML version of the code, 'highlight',
+        including HTML links to all of the calls in that line (if possible)
+
+    Also adds a label adding the total execution of all the lines in the file
+    to the 'file_summary' section.
+
+    :param pdict: profile dict
+    :return: profile dict
+    """
+    total_time = 0.
+    for line, hcode in zip(pdict['lines'], highlight_code(pdict['lines'])):
+        calls_time = 0.
+        for call in line['calls']:
+            calls_time += call['time']
+        line['total_time'] = line['time'] + calls_time
+        total_time += line['total_time']
+
+        line['highlight'] = insert_calls_for_line(hcode, line['calls'])
+
+    pdict['file_summary']['total_time'] = total_time
 
     return pdict
 
@@ -69,38 +113,63 @@ def highlight_line(single_line):
     is_, ie_ = html_code.find('<pre>'), html_code.rfind('</pre>')
     html_code = html_code[is_+len('<pre>'):ie_]
 
-    # add back the <div> and <pre> tags, but for every line and add the highlighted code to the pdict
-    return '<div style="margin-top:-8px;margin-bottom:-8px;" class="highlight"><pre>{0}</pre></div>'.format(html_code.encode('utf-8').decode())
+    # add back the <div> and <pre> tags
+    return HIGHLIGHT_PREFIX + html_code + HIGHLIGHT_SUFFIX
 
 
 def calls_from(line, max_calls_from=5):
     # get the 5 most called from lines
-    cfs = sorted([(key, count) for key, count in line['calls_from'].items()],
-                 key=lambda x: x[1], reverse=True)[:max_calls_from]
+    cfs = heapq.nlargest(max_calls_from, line['calls_from'].items(), key=itemgetter(1))
 
-    tags = [html.href('{0}#line{1}'.format(html.get_html_filename('', file), line),
-                      str(idx + 1)) for idx, ((file, line), cnt) in enumerate(cfs)]
+    tags = [html.href(html.get_line_url(file, line), str(idx + 1)) for idx, ((file, line), cnt) in enumerate(cfs)]
 
     space = '<div style="display:inline-block;height:12px;width:2px;background-color:#eeeeee";></div>'
     return space.join(tags)
 
 
-def insert_call_for_line(code, call):
+def calls_regex(entry_points):
+    """
+    Returns the compiled regular expression matching any of the `entry_points` as a whole word.
+    The compiled expressions are cached since the same sets of entry points are called from
+    many lines
+
+    :param entry_points: sorted tuple of names of the called functions, methods, classes, ...
+
+    :return: compiled regular expression
+    """
+    if entry_points not in CALL_RE_CACHE:
+        # empty the cache once it holds CALL_RE_CACHE_SIZE patterns so it doesn't grow without bounds
+        if len(CALL_RE_CACHE) >= CALL_RE_CACHE_SIZE:
+            CALL_RE_CACHE.clear()
+        CALL_RE_CACHE[entry_points] = re.compile(r'(?<!\w)({0})(?!\w)'.format('|'.join(re.escape(entry_point)
+                                                                                  for entry_point in entry_points)))
+
+    return CALL_RE_CACHE[entry_points]
+
+
+def insert_calls_for_line(code, calls):
     """
-    Replace the call['entry_point'] in `line` with a HTML <a> tag providing a link to the
-    file / line of the actual `call` dict
+    Replace the entry points of the `calls` in `code` with HTML <a> tags providing a link to the
+    file / line of the actual call dicts. All entry points are replaced in a single pass over `code`;
+    if several calls share an entry point the first call is linked.
 
     :param code: string containing the highlighted code
-    :param call: dict containing the information for the specific code
+    :param calls: sequence of dicts containing the information for the calls in the line
 
     :return: updated string
     """
-    replace_string = call['entry_point']
+    hrefs = dict()
+    for call in calls:
+        # an empty entry point would match in between every pair of non-word characters, and
+        # entry points that don't occur in the code at all don't need to go into the regex
+        if call['entry_point'] and call['entry_point'] not in hrefs and call['entry_point'] in code:
+            hrefs[call['entry_point']] = html.href(html.get_line_url(call['file_name'], call['line_number']),
+                                                   call['entry_point'])
 
-    return re.sub(r'(?<!\w)({0})(?!\w)'.format(replace_string),
-                  html.href('{0}#line{1}'.format(html.get_html_filename('', call['file_name']),
-                                                 call['line_number']), replace_string),
-                  code)
+    if not hrefs:
+        return code
+
+    return calls_regex(tuple(sorted(hrefs))).sub(lambda m: hrefs[m.group(0)], code)
 
 
 def handle_lambda(call, line, file):
@@ -109,123 +178,148 @@ def handle_lambda(call, line, file):
     pointed to by the `call` and extracts the name of the variable that gets assigned
     the lambda.
 
-    :param call: call dictionary
+    :param call: call dictionary, updated in place
     :param line: line dictionary
     :param file: file dictionary of the file pointed to by the call
 
-    :return: updated call dictionary
+    :return: False if the call should be dropped, True otherwise
     """
 
     if call['entry_point'] == '<lambda>':
         if line['line_number'] == call['line_number']:
-            return {}
+            return False
 
         num = call['line_number']
         # file the name of the variable defined in file['lines'][num-1]
-        m = re.search(r'(?<=\s)(\w*)(?=\s*=\s*lambda)', file['lines'][num-1]['code'])
+        m = RE_LAMBDA.search(file['lines'][num-1]['code'])
         if m is not None:
             call['entry_point'] = m.group(0)
 
-    return call
+    return True
+
+
+def class_lines_for_file(file, class_lines):
+    """
+    Returns the positions in file['lines'] of the lines holding a class definition and the
+    names of the classes defined on those lines. The result is computed once per file and
+    cached in `class_lines`.
 
+    :param file: file dictionary
+    :param class_lines: dictionary caching the result per file name
 
-def handle_init(call, line, file):
+    :return: tuple (sorted list of positions, list of class names)
+    """
+    name = file['file_summary']['name']
+    if name not in class_lines:
+        positions, names = list(), list()
+        for num, line in enumerate(file['lines']):
+            m = RE_CLASS.search(line['code'])
+            if m is not None:
+                positions.append(num)
+                names.append(m.group(0))
+        class_lines[name] = (positions, names)
+
+    return class_lines[name]
+
+
+def handle_init(call, line, file, class_lines):
     """
     Resolve calls that point to __init__. Finds the preceding class definition in the
     file/line pointed to by the `call` and extracts the name of the class.
 
-    :param call: call dictionary
+    :param call: call dictionary, updated in place
     :param line: line dictionary
     :param file: file dictionary of the file pointed to by the call
-
-    :return: updated call dictionary    """
+    :param class_lines: dictionary caching the class definitions per file, see class_lines_for_file
+    """
     if call['entry_point'] == '__init__':
 
         num = call['line_number']
         # if the line contains the ' cls(' replace the entry point with cls
-        m = re.search(r'(?<=\s)(cls)(?={0})'.format(re.escape('(')), line['code'])
+        m = RE_CLS.search(line['code'])
         if m is not None:
             call['entry_point'] = 'cls'
-            return call
+            return
 
         # otherwise we need to find the first class definition above the line holding the init
-        while num > -1:
-            m = re.search(r'(?<=class\s)(\w*)(?={0})'.format(re.escape('(')), file['lines'][num]['code'])
-            if m is not None:
-                call['entry_point'] = m.group(0)
-                return call
-            num -= 1
+        positions, names = class_lines_for_file(file, class_lines)
+        idx = bisect.bisect_right(positions, num) - 1
+        if idx >= 0:
+            call['entry_point'] = names[idx]
+
+    # if this is not a __init__ entry point or we failed to find one, then the call is left as is
+
+
+def resolve_call(call, line, file, class_lines):
+    """
+    Resolve a single call, in place, by applying the handler for <lambda>s and, if the call
+    is not dropped by that handler, the handler for __init__s
+
+    :param call: call dictionary, updated in place
+    :param line: line dictionary
+    :param file: file dictionary of the file pointed to by the call
+    :param class_lines: dictionary caching the class definitions per file, see class_lines_for_file
+
+    :return: False if the call should be dropped, True otherwise
+    """
+    if not handle_lambda(call, line, file):
+        return False
 
-    # if this is not a __init__ entry point or we failed to find one, then return the call itself
-    return call
+    handle_init(call, line, file, class_lines)
 
+    return True
 
-def resolve_calls_for_file(file, pdict, filemap):
+
+def resolve_calls_for_file(file, file_by_name, class_lines):
     """
     Resolve as many calls as possible in `file`. Used separate handlers for resolving
     <lambda>s and __init__s
 
     :param file: file dictionary
-    :param pdict: profile dictionary
-    :param filemap: map of file_name to file hash in the main profile dictionary
+    :param file_by_name: map of file_name to file dictionary in the main profile dictionary
+    :param class_lines: dictionary caching the class definitions per file, see class_lines_for_file
 
-    :return: updated profile dictionary
+    :return: updated file dictionary
     """
     for line in file['lines']:
-        line['calls'] = [c for c in [handle_lambda(call, line, pdict[filemap[call['file_name']]])
-                                     for call in line['calls']] if len(c) > 0]
-        line['calls'] = [c for c in [handle_init(call, line, pdict[filemap[call['file_name']]])
-                                     for call in line['calls']] if len(c) > 0]
+        line['calls'] = [call for call in line['calls']
+                         if resolve_call(call, line, file_by_name[call['file_name']], class_lines)]
 
-    return pdict
+    return file
 
 
-def resolve_calls(pdict):
+def resolve_calls(files):
     """
     This is an attempt to resolve calls to constructors (__init__) and lambdas. These
-    calls can be across files so we need the entire dict of information
+    calls can be across files so we need the information of all files
 
-    :param pdict: profile dict dictionary
+    :param files: sequence of all file dictionaries in the profile dictionary
 
-    :return: updated profile dictionary
+    :return: updated sequence of file dictionaries
     """
-    filemap = dict((v['file_summary']['name'], k) for k, v in six.iteritems(pdict) if k != 'summary')
+    file_by_name = dict((file['file_summary']['name'], file) for file in files)
+    class_lines = dict()
 
-    for file in [file for k, file in six.iteritems(pdict) if k != 'summary']:
-        pdict = resolve_calls_for_file(file, pdict, filemap)
+    for file in files:
+        resolve_calls_for_file(file, file_by_name, class_lines)
 
-    return pdict
+    return files
 
 
-def clean_pdict(pdict):
+def clean_files(files):
     """
     For some reason pprofile screws up some of the profile stats when profiling cells in and
     ipython notebook. This function attempts cleans up those lines by inserting additional
     "line breaks"
 
-    :param pdict: profile dictionary
-
-    :return: updated profile dictionary
-    """
-    for file in [file for k, file in six.iteritems(pdict) if k != 'summary']:
-        file['lines'] = [line for line in file['lines'] if not line['code'].strip().startswith('(call)')]
-
-    return pdict
-
+    :param files: sequence of all file dictionaries in the profile dictionary
 
-def insert_calls(pdict):
+    :return: updated sequence of file dictionaries
     """
-    For each line insert HTML links to all of the calls in that line (if possible)
+    for file in files:
+        file['lines'] = [line for line in file['lines'] if not line['code'].lstrip().startswith('(call)')]
 
-    :param pdict: profile dictionary
-
-    :return: updated profile dictionary
-    """
-    for line in pdict['lines']:
-        for call in line['calls']:
-            line['highlight'] = insert_call_for_line(line['highlight'], call)
-
-    return pdict
+    return files
 
 
 def html_file_summary(pdict):
@@ -246,6 +340,30 @@ def html_file_summary(pdict):
             '<b>Duration (perc)</b> : {0} &#37</br>'.format(pdict['percentage'])]
 
 
+def hits_cell(line):
+    """HTML for the hits of `line`, empty if the line wasn't hit"""
+    hits = line['hits']
+    return DIV_PRE_PREFIX + str(hits) + DIV_PRE_SUFFIX if hits > 0 else EMPTY_DIV_PRE
+
+
+def total_time_cell(line):
+    """HTML for the total time of `line`, empty if no time was spent in the line"""
+    total_time = line['total_time']
+    return DIV_PRE_PREFIX + FORMAT_TIME(total_time) + DIV_PRE_SUFFIX if total_time > 0 else EMPTY_DIV_PRE
+
+
+def self_time_cell(line):
+    """HTML for the self time of `line`, empty if no time was spent in the line"""
+    time = line['time']
+    return DIV_PRE_PREFIX + FORMAT_TIME(time) + DIV_PRE_SUFFIX if time > 0 else EMPTY_DIV_PRE
+
+
+def time_per_hit_cell(line):
+    """HTML for the time per hit of `line`, empty if no time was spent in the line"""
+    time_per_hit = line['time_per_hit']
+    return DIV_PRE_PREFIX + FORMAT_TIME_PER_HIT(time_per_hit) + DIV_PRE_SUFFIX if time_per_hit > 0 else EMPTY_DIV_PRE
+
+
 def get_column_specs(pdict, summary=False):
     """Return the column specifications for the html table"""
 
@@ -254,11 +372,12 @@ def get_column_specs(pdict, summary=False):
         col8 = lambda l: highlight_line(l['code'].lstrip())
     else:
         col2 = lambda l: html.div('<a name=line{0}>{0}</a>'.format(l['line_number']))
-        col8 = lambda l: l['highlight']
+        col8 = lambda l: HIGHLIGHT_PREFIX + l['highlight'] + HIGHLIGHT_SUFFIX
+
+    total_time = pdict['file_summary']['total_time']
 
     column_specs = (html.column_spec('',
-                                     lambda l: html.box(l['time'], l['total_time'],
-                                                        pdict['file_summary']['total_time']),
+                                     lambda l: html.box(l['time'], l['total_time'], total_time),
                                      40,
                                      padding_left=0,
                                      padding_right=0),
@@ -266,18 +385,16 @@ def get_column_specs(pdict, summary=False):
                                      col2,
                                      40),
                     html.column_spec('hits',
-                                     lambda l: html.div(html.pre('{0}'.format(l['hits'] if l['hits'] > 0 else ''))),
+                                     hits_cell,
                                      70),
                     html.column_spec('total time',
-                                     lambda l: html.div(html.pre('{0:.4f}'.format(l['total_time'])
-                                                                 if l['total_time'] > 0 else '')),
+                                     total_time_cell,
                                      70),
                     html.column_spec('self time',
-                                     lambda l: html.div(html.pre('{0:.4f}'.format(l['time']) if l['time'] > 0 else '')),
+                                     self_time_cell,
                                      70),
                     html.column_spec('time per hit',
-                                     lambda l: html.div(html.pre('{0:.2e}'.format(l['time_per_hit'])
-                                                                 if l['time_per_hit'] > 0 else '')),
+                                     time_per_hit_cell,
                                      70),
                     html.column_spec('called from',
                                      lambda l: html.div(calls_from(l)),
@@ -293,72 +410,64 @@ def get_column_specs(pdict, summary=False):
     return column_specs
 
 
-def html_file_most_expensive(pdict, max_lines=10):
+def html_file_most_expensive(h, pdict, max_lines=10):
     """
     Generate the HTML for the most expensive lines section. This includes all the information
     for the most expensive `max_lines` lines. The line number in the section are HTML link to
     the actual lines in the source code section.
 
+    :param h: html object the HTML for the most expensive lines section is added to
     :param pdict: profile dictionary
 
-    :return: sequence containing the HTML for the most expensive lines section
+    :return: html object
     """
     # sort lines by total_time in reverse order
-    sorted_lines = sorted([line for line in pdict['lines']],
-                          key=lambda l: l['total_time'],
-                          reverse=True)[:max_lines]
+    sorted_lines = heapq.nlargest(max_lines, pdict['lines'], key=itemgetter('total_time'))
 
     # columns_specs for the table columns of the most expensive lines section
     column_specs = get_column_specs(pdict, summary=True)
 
     # generate the HTML
-    h = html.html()
-
     with h.title():
-        h.add('most expensive lines')
+        h.append('most expensive lines')
     with h.table():
         # header row
         with h.table_row():
             for c in column_specs:
-                h.add(c(None, header=True))
+                h.append(c.header())
         # content rows
-        for line in sorted_lines:
-            with h.table_row():
-                for c in column_specs:
-                    h.add(c(line))
+        row = html.row_emitter(column_specs)
+        h.extend(row(line) for line in sorted_lines)
 
-    return h.buffer
+    return h
 
 
-def html_file_lines(pdict):
+def html_file_lines(h, pdict):
     """
     Generate the HTML for the source code section.
 
+    :param h: html object the HTML for the source code section is added to
     :param pdict: profile dictionary
 
-    :return: sequence containing the HTML for the most expensive lines section
+    :return: html object
     """
 
     # columns_specs for the table columns of the source section
     column_specs = get_column_specs(pdict)
 
     # generate the html
-    h = html.html()
-
     with h.title():
-        h.add('source code')
+        h.append('source code')
     with h.table():
         # header row
         with h.table_row():
             for c in column_specs:
-                h.add(c(None, header=True))
+                h.append(c.header())
         # content rows
-        for line in pdict['lines']:
-            with h.table_row():
-                for c in column_specs:
-                    h.add(c(line))
+        row = html.row_emitter(column_specs)
+        h.extend(row(line) for line in pdict['lines'])
 
-    return h.buffer
+    return h
 
 
 def html_file(pdict, output_dir):
@@ -371,25 +480,19 @@ def html_file(pdict, output_dir):
     :return: updated profile dictionary
     """
     # each line has a 'time', or self_time, and a 'total_time', which is the time spent
-    # in the line itself and in its calls. so add the total_time to the line dict
-    pdict = add_total_time(pdict)
-    # include pretty syntax highlighting
-    pdict = highlight_code(pdict)
-    # add HTML links for calls
-    pdict = insert_calls(pdict)
-
-    # generate the html
-    h = html.html()
+    # in the line itself and in its calls. so add the total_time to the line dict, and
+    # include pretty syntax highlighting with HTML links for calls
+    pdict = prepare_lines(pdict)
 
-    with h.preamble():
-        h.add(html_file_summary(pdict['file_summary']))
-        h.add(html.hrule())
-        h.add(html_file_most_expensive(pdict))
-        h.add(html_file_lines(pdict))
+    # generate the html and write it to file
+    with html.open_html(html.get_html_filename(output_dir, pdict['file_summary']['name'])) as f:
+        h = html.html(f)
 
-    # write the html to file
-    with open(html.get_html_filename(output_dir, pdict['file_summary']['name']), 'w') as f:
-        f.write(''.join(h.buffer))
+        with h.preamble():
+            h.extend(html_file_summary(pdict['file_summary']))
+            h.append(html.hrule())
+            html_file_most_expensive(h, pdict)
+            html_file_lines(h, pdict)
 
     return pdict
 
@@ -403,11 +506,13 @@ def html_files(pdict, output_dir):
 
     :return: updated profile dictionary
     """
+    # the file dictionaries, separated from the summary once
+    files = [v for k, v in six.iteritems(pdict) if k != 'summary']
 
-    pdict = clean_pdict(pdict)
-    pdict = resolve_calls(pdict)
+    files = clean_files(files)
+    files = resolve_calls(files)
 
-    for fdict in (v for k, v in six.iteritems(pdict) if k != 'summary'):
+    for fdict in files:
         html_file(fdict, output_dir)
 
     return pdict
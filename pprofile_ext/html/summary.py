@@ -51,26 +51,21 @@ def html_summary(pdict, output_dir):
                                      align='left')
                     )
 
-    # generate the html
-    h = html.html()
+    # generate the html and write it to disk
+    with html.open_html(os.path.abspath(os.path.join(output_dir, 'index.html'))) as f:
+        h = html.html(f)
 
-    with h.preamble():
-        with h.title():
-            h.add('most expensive files')
-        with h.table():
-            # header row
-            with h.table_row():
-                for c in column_specs:
-                    h.add(c(None, header=True))
-            # content rows
-            for fs in file_summaries:
+        with h.preamble():
+            with h.title():
+                h.append('most expensive files')
+            with h.table():
+                # header row
                 with h.table_row():
                     for c in column_specs:
-                        h.add(c(fs))
-
-    # write the file to disk
-    with open(os.path.abspath(os.path.join(output_dir, 'index.html')), 'w') as f:
-        f.write(''.join(h.buffer))
+                        h.append(c.header())
+                # content rows
+                row = html.row_emitter(column_specs)
+                h.extend(row(fs) for fs in file_summaries)
 
     # return the parsed dictionary
     return pdict
@@ -7,12 +7,10 @@ def command_line_parser(line):
     :param line: sequence of lines
     :return: string containing the command_line, e.g., 'to_html.py'
     """
-    idx_start, idx_end = line.find("['"), line.find("']")
+    _, start, command_line = line.partition("['")
+    command_line, end, _ = command_line.partition("']")
 
-    if idx_start == -1 or idx_end == -1:
-        return ''
-    else:
-        return line[idx_start+2:idx_end]
+    return command_line if start and end else ''
 
 
 def total_duration_parser(line):
@@ -30,21 +28,28 @@ def total_duration_parser(line):
         return 0.
 
 
-def file_duration_parser(line):
+def file_duration_and_percentage_parser(line):
     """
-    Parses lines of the following form: extracts only the seconds part
+    Parses lines of the following form: extracts both the seconds and the percentage part
 
         File duration: 5248.68s (100.00%)
 
     :param line: string
-    :return: float containing the duration for the file in seconds
+    :return: tuple of floats containing the duration for the file in seconds and in percentage
     """
-    line = line[len('File duration:'):]
-    ie = line.find('s')
+    duration, _, percentage = line[len('File duration:'):].partition('s')
+    percentage = percentage.partition('(')[2].partition('%')[0]
+
     try:
-        return float(line[:ie])
+        duration = float(duration)
     except:
-        return 0.
+        duration = 0.
+    try:
+        percentage = float(percentage)
+    except:
+        percentage = 0.
+
+    return duration, percentage
 
 
 def file_name_parser(line):
@@ -63,23 +68,6 @@ def file_name_parser(line):
         return line[ie+1:].strip()
 
 
-def file_percentage_parser(line):
-    """
-    Parses lines of the following form: extracts only the seconds part
-
-        File duration: 5248.68s (100.00%)
-
-    :param line: string
-    :return: float containing the duration for the file in percentage
-    """
-    is_ = line.find('(')
-    ie_ = line.find('%')
-    try:
-        return float(line[is_+1:ie_])
-    except:
-        return 0.
-
-
 def parse_line(line):
     """
     Parses lines of the following form
@@ -93,14 +81,15 @@ def parse_line(line):
     :param line: string
     :return: tuple
     """
-    columns = line.split('|')
+    # split off the five numeric columns only, the source code may contain '|' itself
+    columns = line.split('|', 5)
 
     return {'line_number': int(columns[0]),
             'hits': int(columns[1]),
             'time': float(columns[2]),
             'time_per_hit': float(columns[3]),
             'percentage': float(columns[4][:-1]),
-            'code': '|'.join(columns[5:]),
+            'code': columns[5],
             'calls': list(),
             'calls_from': dict()
             }
@@ -119,7 +108,7 @@ def parse_call(line):
     :param line: string
     :return: tuple
     """
-    columns = line.split('|')
+    columns = line.split('|', 5)
     first, sep, second = columns[5].rpartition(':')
     line_number, sep, entry_point = second.partition(' ')
     file_name = first.strip('# ')
@@ -1,34 +1,59 @@
-import collections
+import functools
 import hashlib
 
 import six
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# the hashes are only used as keys for the files within a single profile, so a short blake2b
+# digest (python >= 3.6) is plenty; fall back to sha1 where blake2b isn't available
+if hasattr(hashlib, 'blake2b'):
+    HASH = functools.partial(hashlib.blake2b, digest_size=10)
+else:
+    HASH = hashlib.sha1
+
 HASH_CACHE = dict()
+HASH_CACHE_SIZE = 8192
 
 
 def update(d, u):
     """
-    Perform a recursive update of dictionary `d` with the dictionary `u`
+    Perform a recursive update of dictionary `d` with the dictionary `u`. The nested
+    dictionaries are walked with an explicit stack rather than by recursion.
+
+    The profile parser no longer uses this function; it is kept as a public helper.
 
     :param d: dictionary
     :param u: dictionary
 
     :return: updated dictionary
     """
-    for k, v in six.iteritems(u):
-        if isinstance(v, collections.Mapping):
-            r = update(d.get(k, {}), v)
-            d[k] = r
-        else:
-            d[k] = u[k]
+    stack = [(d, u)]
+    while stack:
+        dd, uu = stack.pop()
+        for k, v in six.iteritems(uu):
+            if isinstance(v, Mapping):
+                sub = dd.get(k)
+                if sub is None:
+                    # copy into a new dictionary, so `d` doesn't share the nested dictionaries of `u`
+                    sub = dd[k] = dict()
+                stack.append((sub, v))
+            else:
+                dd[k] = v
 
     return d
 
 
 def hashkey(key):
-    """Returns the sha1 hash for key"""
-    # hash keys so we don't pay the sha1 overhead each time we call this one
+    """Returns the hash for key"""
+    # hash keys so we don't pay the hash overhead each time we call this one; the cache
+    # is emptied once it holds HASH_CACHE_SIZE keys so it doesn't grow without bounds
     if key not in HASH_CACHE:
-        HASH_CACHE[key] = hashlib.sha1(str.encode(key)).hexdigest()
+        if len(HASH_CACHE) >= HASH_CACHE_SIZE:
+            HASH_CACHE.clear()
+        HASH_CACHE[key] = HASH(key.encode('utf-8') if isinstance(key, six.text_type) else key).hexdigest()
 
     return HASH_CACHE[key]